@@ -2,6 +2,8 @@ import pandas as pd
 pd.set_option('display.max_columns', 500)
 import xlsxwriter
 import sys
+import json
+import numpy as np
 
 # new name fr the columns in the normalised dataframe to be mapped to the target schema
 DIC_COLS_RENAME = {
@@ -11,9 +13,32 @@ DIC_COLS_RENAME = {
             'ModelText': 'model',                    # assumed normalized
             'ModelTypeText': 'model_variant',        # assumed normalized
             'Km': 'mileage',                         # assumed normalized
+            'FirstRegYear': 'manufacture_year',      # assumed normalized
+            'FirstRegMonth': 'manufacture_month',    # assumed normalized
             'Country': 'country'
             }
 
+# declarative mapping of the normalised dataframe to the target schema. The renames and drops are applied in one projection
+# (see project_to_target), the order and dtypes to the integrated dataframe (see apply_target_schema)
+SCHEMA_MAPPING = {
+            'rename': DIC_COLS_RENAME,  # column in the normalised dataframe -> column in the target schema
+            'order': None,              # list of the first columns in the output, the other columns follow in the order of the target dataframe
+            'drop': [],                 # target columns to drop, columns that are not in the target dataframe are always dropped
+            'dtypes': {                 # target column -> numeric dtype, values that are not numeric become missing
+                'manufacture_year': 'Int64',
+                'manufacture_month': 'float64',
+                'mileage': 'float64'
+                }
+            }
+
+# columns of the target schema that identify a vehicle, used to detect duplicates
+COLS_DEDUP_KEY = ['make', 'model', 'model_variant', 'mileage', 'city', 'condition', 'color', 'manufacture_year', 'manufacture_month']
+# columns of the target schema used as blocking key to detect near-duplicates (compared without case, whitespace and punctuation)
+COLS_DEDUP_BLOCK = ['make', 'model', 'model_variant', 'city', 'condition', 'color']
+# size of the mileage buckets for near-duplicates, vehicles in the same block whose mileage is in the same or a neighbouring
+# bucket (i.e. differs by less than 2 x DEDUP_MILEAGE_TOLERANCE) are considered near-duplicates
+DEDUP_MILEAGE_TOLERANCE = 1000
+
 
 
 
@@ -25,6 +50,7 @@ class Integrator():
         self.path_prepro_file = path_prepro_file # path to the preprocessed datafrile
         self.path_xlsx_output = path_xlsx_output # path where the final output xlsx will be stored
         self.path_integr_output = path_integr_output # path where csv of the integrator will be stored, only for internal processing and debugging
+        self.df_duplicates = None # supplier vehicles found as duplicates when appending to the target, for audit
 
     def load_normalised(self):
         """
@@ -52,55 +78,186 @@ class Integrator():
         return data
 
 
-    def rename_columns(self, data, dic_cols_rename=DIC_COLS_RENAME):
+    def load_schema_mapping(self, path_schema_mapping):
         """
-        Renames the columns in the normalised dataframe so they can be appended to the target dataframe.
+        Loads the mapping of the normalised dataframe to the target schema from a json file with the keys of SCHEMA_MAPPING.
+        Missing keys are taken from SCHEMA_MAPPING.
         INPUT:
-            - data: pandas dataframe that is the normalised dataframe
-            - dic_cols_rename: dictionary with the mapping between the columns to be renamed
+            - path_schema_mapping: path to the json file
         OUTPUT:
-            - pandas dataframe with the renamed columns
+            - dictionary with the schema mapping
         """
-        for k in dic_cols_rename.keys():
-            assert k in data.columns, f"Error in rename_columns! Column {k} is not in the columns if the dataframe which are {data.columns.tolist()}."
+        assert path_schema_mapping.endswith('.json'), f"Error in load_schema_mapping, filename does not end with .json"
+        with open(path_schema_mapping, 'r') as f:
+            spec = json.load(f)
+        for k in spec.keys():
+            assert k in SCHEMA_MAPPING, f"Error in load_schema_mapping! Key {k} is not one of {list(SCHEMA_MAPPING.keys())}."
 
-        data = data.rename(dic_cols_rename, axis=1)
+        return {**SCHEMA_MAPPING, **spec}
 
-        return data
 
+    def compile_projection(self, columns, target_columns, spec=SCHEMA_MAPPING):
+        """
+        Compiles the schema mapping into the columns to select and their new names, so that it can be applied in one operation.
+        INPUT:
+            - columns: list of the columns of the normalised dataframe
+            - target_columns: list of the columns of the target dataframe
+            - spec: dictionary with the schema mapping, see SCHEMA_MAPPING
+        OUTPUT:
+            - list of the columns to select from the normalised dataframe
+            - list of the new names of these columns in the target schema
+        """
+        for k in spec['rename'].keys():
+            assert k in columns, f"Error in compile_projection! Column {k} is not in the columns if the dataframe which are {list(columns)}."
 
-    def drop_columns(self, data, data_tar):
+        # target column -> column in the normalised dataframe, the first column wins if two are mapped to the same name
+        dic_source = {}
+        for c in columns:
+            dic_source.setdefault(spec['rename'].get(c, c), c)
+
+        target_cols = [c for c in target_columns if c in dic_source and c not in spec['drop']]
+        source_cols = [dic_source[c] for c in target_cols]
+
+        return source_cols, target_cols
+
+
+    def project_to_target(self, data, data_tar, spec=SCHEMA_MAPPING):
         """
-        Drops the columns in the normalised dataframe that have no match in the target dataframe.
+        Maps the normalised dataframe to the target schema in one projection: selects and renames the columns in a single
+        operation, so the dataframe is copied only once.
         INPUT:
             - data: pandas dataframe that is the normalised dataframe
             - data_tar: target dataframe, any column in data that is not in data_tar will be dropped from data
+            - spec: dictionary with the schema mapping, see SCHEMA_MAPPING
         OUTPUT:
-            - pandas dataframe of supplier data with the dropped columns
+            - pandas dataframe with the columns of the target schema
         """
+        source_cols, target_cols = self.compile_projection(data.columns, data_tar.columns, spec)
+
+        data = data[source_cols]
+        data.columns = target_cols
+
+        return data
+
 
-        # get list of columns to drop
-        cols_to_drop = []
-        for col in data.columns:
-            if col not in data_tar.columns:
-                cols_to_drop.append(col)
+    def apply_target_schema(self, data, spec=SCHEMA_MAPPING):
+        """
+        Applies the column order and the dtypes of the schema mapping to the integrated dataframe, after the supplier dataset
+        was appended to the target dataset and the missing values were filled.
+        INPUT:
+            - data: pandas dataframe of supplier data appended to target data
+            - spec: dictionary with the schema mapping, see SCHEMA_MAPPING
+        OUTPUT:
+            - pandas dataframe with the ordered columns and the numeric columns cast to their dtype (values that are not numeric,
+                e.g. 'null', become missing)
+        """
+        if spec['order'] is not None:
+            cols_ordered = [c for c in spec['order'] if c in data.columns]
+            data = data[cols_ordered + [c for c in data.columns if c not in cols_ordered]]
 
-        data = data.drop(columns=cols_to_drop)
+        dic_cast = {c: pd.to_numeric(data[c], errors='coerce').astype(dtype) for c, dtype in spec['dtypes'].items() if c in data.columns}
+        data = data.assign(**dic_cast)
 
         return data
 
 
-    def append_supplier_to_target(self, data, data_tar):
+    def find_duplicates(self, data, data_tar, key_cols=COLS_DEDUP_KEY, block_cols=COLS_DEDUP_BLOCK, mileage_tolerance=DEDUP_MILEAGE_TOLERANCE):
+        """
+        Finds the vehicles of the supplier dataset that are already in the target dataset or in an earlier row of the supplier dataset.
+        Instead of comparing all pairs of vehicles, a hash is computed for the normalised key columns of every vehicle and looked up in
+        one hash index over the target and the supplier dataset, so the runtime grows linearly with the number of vehicles.
+            - exact: all key columns are equal after normalising case and whitespace
+            - near: the block columns are equal after also removing punctuation, and the mileage is in the same or a neighbouring
+                    bucket of size mileage_tolerance (i.e. differs by less than two times mileage_tolerance)
+        INPUT:
+            - data: pandas dataframe that is the normalised dataframe with columns matching those to the target dataset
+            - data_tar: target dataframe
+            - key_cols: list of the columns that identify a vehicle
+            - block_cols: list of the columns that must match for a near-duplicate, the mileage is compared with the tolerance
+            - mileage_tolerance: size of the mileage buckets for the near-duplicates
+        OUTPUT:
+            - pandas series with the same index as data with the values "exact", "near" or "new"
+        """
+        for k in key_cols + block_cols + ['mileage']:
+            assert k in data.columns, f"Error in find_duplicates! Column {k} is not in the columns of the supplier dataset."
+            assert k in data_tar.columns, f"Error in find_duplicates! Column {k} is not in the columns of the target dataset."
+
+        def normalise_keys(df, cols, compact=False):
+            """
+            Returns the normalised key columns: lowercase strings without repeated whitespace (or without any non-alphanumeric
+            character if compact) and the mileage as number. Missing values ('null' in the target dataset) become empty strings.
+            """
+            keys = pd.DataFrame(index=df.index)
+            for c in cols:
+                if c == 'mileage':
+                    keys[c] = pd.to_numeric(df[c], errors='coerce').round(0)
+                else:
+                    col = df[c].astype(str).str.lower().str.strip()
+                    col = col.where(~col.isin(['nan', 'none', 'null']), '')
+                    keys[c] = col.str.replace(r'[^0-9a-z]', '', regex=True) if compact else col.str.replace(r'\s+', ' ', regex=True)
+            return keys
+
+        def hash_keys(keys):
+            return pd.util.hash_pandas_object(keys, index=False)
+
+        # all vehicles in one frame, the target rows first, so every supplier row is compared to the target and to the earlier supplier rows
+        cols = list(dict.fromkeys(key_cols + block_cols + ['mileage']))
+        data_all = pd.concat([data_tar[cols], data[cols]], ignore_index=True)
+        position = np.arange(len(data_all))
+        is_supplier = position >= len(data_tar)
+
+        # exact duplicates
+        is_exact = hash_keys(normalise_keys(data_all, key_cols)).duplicated().values[is_supplier]
+
+        # near duplicates: index with the first position of every (block hash, mileage bucket), looked up for the buckets -1, 0 and +1
+        hash_block = hash_keys(normalise_keys(data_all, block_cols, compact=True)).values
+        bucket = (pd.to_numeric(data_all['mileage'], errors='coerce') // mileage_tolerance).values
+        has_bucket = ~np.isnan(bucket)
+        index_near = pd.Series(position[has_bucket], index=pd.MultiIndex.from_arrays([hash_block[has_bucket], bucket[has_bucket]]))
+        index_near = index_near.groupby(level=[0, 1]).min()
+
+        is_near = np.zeros(is_supplier.sum(), dtype=bool)
+        for offset in [-1, 0, 1]:
+            lookup = pd.MultiIndex.from_arrays([hash_block[is_supplier], bucket[is_supplier] + offset])
+            position_match = index_near.reindex(lookup).values
+            is_near = is_near | (position_match < position[is_supplier]) # NaN (no match) compares as False
+
+        duplicates = pd.Series('new', index=data.index)
+        duplicates[is_near] = 'near'
+        duplicates[is_exact] = 'exact'
+
+        return duplicates
+
+
+    def append_supplier_to_target(self, data, data_tar, on_duplicate=None, on_near_duplicate=None):
         """
         Appends the supplier dataset to the target dataset.
         INPUT:
             - data: pandas dataframe that is the normalised dataframe with columns matching those to the target dataset
             - data_tar: target dataframe, any column in data that is not in data_tar will be dropped from data
+            - on_duplicate: what to do with the exact duplicates of vehicles that are already in the target dataset (see find_duplicates).
+                            None appends them without checking, "drop" does not append them, "flag" appends them.
+                            Dropped and flagged duplicates are stored in the attribute df_duplicates for audit (see save_xlsx).
+            - on_near_duplicate: same as on_duplicate for the near duplicates
         OUTPUT:
-            - pandas dataframe of supplier data appended to target data
+            - pandas dataframe of supplier data appended to target data, with the columns of the target dataset
         """
         for k in data.columns:
             assert k in data_tar.columns, f"Error in append_supplier_to_target! Column {k} of processed supplier dataset is not in the target dataset."
+        for on in [on_duplicate, on_near_duplicate]:
+            assert on in [None, 'drop', 'flag'], f"Error in append_supplier_to_target! on_duplicate and on_near_duplicate are {on_duplicate} and {on_near_duplicate}, must be None, 'drop' or 'flag'"
+
+        if on_duplicate is not None or on_near_duplicate is not None:
+            duplicates = self.find_duplicates(data, data_tar)
+            to_drop = ((duplicates == 'exact') & (on_duplicate == 'drop')) | ((duplicates == 'near') & (on_near_duplicate == 'drop'))
+            to_flag = ((duplicates == 'exact') & (on_duplicate == 'flag')) | ((duplicates == 'near') & (on_near_duplicate == 'flag'))
+
+            # dropped and flagged duplicates for audit
+            is_audit = (to_drop | to_flag).values
+            df_duplicates = data[is_audit].assign(duplicate=duplicates.values[is_audit], action=np.where(to_drop.values[is_audit], 'dropped', 'flagged'))
+            self.df_duplicates = df_duplicates.rename_axis('ID').reset_index()
+
+            data = data[~to_drop.values]
 
         data = data.reset_index(drop=True) # reset the ID index
 
@@ -116,6 +273,8 @@ class Integrator():
     def save_xlsx(self, data, df_prepro=None, df_norm=None):
         """
         Saves all the files in this task in one single xlsx file with each step in a different sheet.
+        If the normalised dataframe contains the city clusters, their mapping to the countries is saved in the sheet Cities.
+        If duplicates were checked when appending to the target, the dropped and flagged supplier vehicles are saved in the sheet Duplicates.
         INPUT:
             - data: pandas dataframe that is the normalised dataframe
             - data_tar: target dataframe, any column in data that is not in data_tar will be dropped from data
@@ -158,9 +317,24 @@ class Integrator():
             n_rows, n_cols = df_norm.shape[0], df_norm.shape[1]
             apply_autofilter(writer, n_rows, n_cols, sheet_name)
 
+            if 'CityCluster' in df_norm.columns:
+                # mapping of the cities to the geocoded clusters and countries for audit
+                sheet_name = 'Cities'
+                df_cities = df_norm[['City', 'CityCluster', 'CitySuggestion', 'Country']].drop_duplicates().sort_values(['CityCluster', 'City'])
+                df_cities.to_excel(writer, sheet_name=sheet_name, index=None)
+                n_rows, n_cols = df_cities.shape[0], df_cities.shape[1]
+                apply_autofilter(writer, n_rows, n_cols, sheet_name)
+
             sheet_name = 'Integration'
             df_comb.to_excel(writer, sheet_name=sheet_name, index=None)
             n_rows, n_cols = df_comb.shape[0], df_comb.shape[1]
             apply_autofilter(writer, n_rows, n_cols, sheet_name)
 
+            if self.df_duplicates is not None:
+                # supplier vehicles that were dropped or flagged as duplicates when appending to the target for audit
+                sheet_name = 'Duplicates'
+                self.df_duplicates.to_excel(writer, sheet_name=sheet_name, index=None)
+                n_rows, n_cols = self.df_duplicates.shape[0], self.df_duplicates.shape[1]
+                apply_autofilter(writer, n_rows, n_cols, sheet_name)
+
         return None
\ No newline at end of file
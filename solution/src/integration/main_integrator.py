@@ -2,17 +2,22 @@ import pandas as pd
 import getopt
 import sys
 
-from Integrator import Integrator
+from Integrator import Integrator, SCHEMA_MAPPING
 
+# what to do with supplier vehicles that are already in the target dataset: None (append), 'drop' or 'flag'
+ON_DUPLICATE = 'drop' # exact duplicates
+ON_NEAR_DUPLICATE = 'flag' # near duplicates, can be different vehicles with similar attributes, so they are only flagged in the sheet Duplicates
 
 
-def integrate_datasets(data_norm, data_target, path_xlsx_output, integrator=None, df_prepro=None, df_norm=None):
+
+def integrate_datasets(data_norm, data_target, path_xlsx_output, integrator=None, df_prepro=None, df_norm=None, path_schema_mapping=None):
 	"""
 	Integrates the supplier dataset into the target schema.
 	INPUT:
 		- data_norm: preprocessed and normalised supplier dataset, must be in wide format
 		- data_target: target dataset
 		- path_xlsx_output: full path where to save the final xlsx file
+		- path_schema_mapping: (optional) path to a json file with the mapping to the target schema, if None SCHEMA_MAPPING is used
 	OUTPUT:
 		- pandas dataframe
 	"""
@@ -25,14 +30,17 @@ def integrate_datasets(data_norm, data_target, path_xlsx_output, integrator=None
 				path_integr_output=None
 			)
 
-	# renames the columns in the normalised dataframe so they can be appended to the target dataframe
-	data = integrator.rename_columns(data_norm)
+	# mapping of the normalised dataframe to the target schema
+	spec = integrator.load_schema_mapping(path_schema_mapping) if path_schema_mapping is not None else SCHEMA_MAPPING
 
-	# drops the columns in the normalised dataframe that have no match in the target dataframe
-	data = integrator.drop_columns(data, data_target)
+	# maps the normalised dataframe to the target schema: renames the columns and drops those that have no match in the target dataframe
+	data = integrator.project_to_target(data_norm, data_target, spec=spec)
 
 	# appends the supplier dataset to the target dataset
-	data = integrator.append_supplier_to_target(data, data_target)
+	data = integrator.append_supplier_to_target(data, data_target, on_duplicate=ON_DUPLICATE, on_near_duplicate=ON_NEAR_DUPLICATE)
+
+	# orders the columns and casts the dtypes of the integrated dataframe
+	data = integrator.apply_target_schema(data, spec=spec)
 
 	# saves all the files in this task in one single xlsx file with each step in a different sheet
 	integrator.save_xlsx(data, df_prepro=df_prepro, df_norm=df_norm)
@@ -43,7 +51,7 @@ def integrate_datasets(data_norm, data_target, path_xlsx_output, integrator=None
 
 
 
-def main(path_normalised_file, path_target_file, path_prepro_file, path_xlsx_output, path_integr_output=None):
+def main(path_normalised_file, path_target_file, path_prepro_file, path_xlsx_output, path_integr_output=None, path_schema_mapping=None):
 	# call object
 	integr = Integrator(
 			path_normalised_file=path_normalised_file,
@@ -59,7 +67,7 @@ def main(path_normalised_file, path_target_file, path_prepro_file, path_xlsx_out
 	# load target dataframe
 	data_target = integr.load_target()
 
-	data = integrate_datasets(data_norm=data, data_target=data_target, path_xlsx_output=path_xlsx_output, integrator=integr)
+	data = integrate_datasets(data_norm=data, data_target=data_target, path_xlsx_output=path_xlsx_output, integrator=integr, path_schema_mapping=path_schema_mapping)
 
 	# write output csv file
 	if path_integr_output: data.to_csv(path_integr_output, index=True)
@@ -69,7 +77,15 @@ if __name__ == '__main__':
 	argv = sys.argv[1:]
 
 	try:
-		if len(argv) == 5:
+		if len(argv) == 6:
+			path_normalised_file = argv[0]
+			path_target_file = argv[1]
+			path_prepro_file = argv[2]
+			path_xlsx_output = argv[3]
+			path_integr_output = argv[4]
+			path_schema_mapping = argv[5]
+			main(path_normalised_file, path_target_file, path_prepro_file, path_xlsx_output, path_integr_output, path_schema_mapping)
+		elif len(argv) == 5:
 			path_normalised_file = argv[0]
 			path_target_file = argv[1]
 			path_prepro_file = argv[2]
@@ -83,13 +99,13 @@ if __name__ == '__main__':
 			path_xlsx_output = argv[3]
 			main(path_normalised_file, path_target_file, path_prepro_file, path_xlsx_output)
 		else:
-			print('Error! usage: main_integrator.py path_normalised_file path_target_file path_prepro_file path_xlsx_output (optional: path_integr_output)')
+			print('Error! usage: main_integrator.py path_normalised_file path_target_file path_prepro_file path_xlsx_output (optional: path_integr_output path_schema_mapping)')
 			sys.exit(2)
 
 
 	except getopt.GetoptError:
 		# Print something useful
-		print('Error! usage: main_integrator.py path_normalised_file path_target_file path_prepro_file path_xlsx_output (optional: path_integr_output)')
+		print('Error! usage: main_integrator.py path_normalised_file path_target_file path_prepro_file path_xlsx_output (optional: path_integr_output path_schema_mapping)')
 
 
 		sys.exit(2)
\ No newline at end of file
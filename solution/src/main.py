@@ -12,6 +12,8 @@ import main_integrator
 path_input_file = '../../data/supplier_car.json'
 path_target_file = '../../data/Target Data.xlsx'
 path_xlsx_output = '../output/integrated_supplier_data.xlsx'
+# (optional) path to a json file with the mapping to the target schema, can be passed as command-line argument
+path_schema_mapping = sys.argv[1] if len(sys.argv) > 1 else None
 
 # read target dataframe
 data_target = pd.read_excel(path_target_file)
@@ -32,7 +34,8 @@ data_integr = main_integrator.integrate_datasets(
 													path_xlsx_output=path_xlsx_output,
 													integrator=None,
 													df_prepro=data_prepro,
-													df_norm=data_norm
+													df_norm=data_norm,
+													path_schema_mapping=path_schema_mapping
 												)
 
 # data_integr.to_csv('../output/integration/integration.csv')
\ No newline at end of file
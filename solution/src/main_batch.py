@@ -0,0 +1,255 @@
+import os
+import sys
+import getopt
+import traceback
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Manager
+sys.path.insert(1, './preprocessing/')
+sys.path.insert(1, './normalisation/')
+sys.path.insert(1, './integration/')
+
+import main_preprocess
+import main_normaliser
+import main_integrator
+
+# SETTINGS
+path_manifest_file = '../../data/manifest.txt'
+path_target_file = '../../data/Target Data.xlsx'
+path_xlsx_output = '../output/integrated_supplier_data.xlsx'
+
+MAX_WORKERS = None # number of worker processes, None uses the number of processors of the machine
+COL_SUPPLIER = 'SupplierFile' # column added to the supplier datasets with the path of the supplier file
+
+# state of a worker process, set once per worker by init_worker instead of being sent with every supplier file
+WORKER_STATE = {}
+
+
+
+
+def read_manifest(path_manifest_file):
+	"""
+	Reads the manifest of the supplier files. One path to a supplier json file per line, empty lines and lines starting with # are ignored.
+	INPUT:
+		- path_manifest_file: path to the manifest file
+	OUTPUT:
+		- list of the paths to the supplier files
+	"""
+	with open(path_manifest_file, 'r') as f:
+		lines = [l.strip() for l in f.readlines()]
+
+	paths = [l for l in lines if l and not l.startswith('#')]
+	assert len(paths) > 0, f"Error in read_manifest! No supplier files found in {path_manifest_file}"
+
+	return paths
+
+
+def init_worker(data_target, caches):
+	"""
+	Initialises a worker process with the target dataset and the shared caches, so they are sent once per worker.
+	INPUT:
+		- data_target: target dataset
+		- caches: dictionary with the caches that are shared between the workers, see main_normaliser.normalise_local
+	OUTPUT:
+		- None
+	"""
+	WORKER_STATE['data_target'] = data_target
+	WORKER_STATE['caches'] = caches
+
+
+def process_supplier(path_input_file):
+	"""
+	Runs the preprocessing and the normalisation steps without external API calls for one supplier file (see main_normaliser.normalise_local).
+	Uses the target dataset and the caches of the worker (see init_worker). Any error is caught so that one supplier can not stop the batch.
+	INPUT:
+		- path_input_file: path to the supplier json file
+	OUTPUT:
+		- tuple of the path, the preprocessed dataframe, the normalised dataframe and the error message (None if successful)
+	"""
+	try:
+		data_prepro = main_preprocess.main(path_input_file)
+		data_norm = main_normaliser.normalise_local(data_supplier=data_prepro.copy(), data_target=WORKER_STATE['data_target'], caches=WORKER_STATE['caches'])
+	except Exception:
+		return path_input_file, None, None, traceback.format_exc()
+
+	return path_input_file, data_prepro, data_norm, None
+
+
+def run_isolated(paths_input_files, data_target, caches, max_workers=MAX_WORKERS):
+	"""
+	Runs process_supplier for each supplier file in its own single-worker pool, up to max_workers pools at once,
+	so that a supplier file that crashes its worker process only fails itself.
+	INPUT:
+		- paths_input_files: list of paths to the supplier json files
+		- data_target: target dataset
+		- caches: dictionary with the caches that are shared between the workers
+		- max_workers: number of pools that run at once, None uses the number of processors of the machine
+	OUTPUT:
+		- list with the result of process_supplier for each supplier file, in the order of paths_input_files
+	"""
+	n_pools = max_workers if max_workers is not None else os.cpu_count()
+	results = [None] * len(paths_input_files)
+	idx_pending = list(range(len(paths_input_files)))
+	running = {} # future -> (index of the supplier file, executor)
+
+	while idx_pending or running:
+		while idx_pending and len(running) < n_pools:
+			ii = idx_pending.pop(0)
+			executor = ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(data_target, caches))
+			running[executor.submit(process_supplier, paths_input_files[ii])] = (ii, executor)
+
+		done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+		for future in done:
+			ii, executor = running.pop(future)
+			try:
+				results[ii] = future.result()
+			except BrokenProcessPool:
+				results[ii] = (paths_input_files[ii], None, None, 'The worker process died.')
+			except Exception:
+				results[ii] = (paths_input_files[ii], None, None, traceback.format_exc())
+			executor.shutdown()
+
+	return results
+
+
+def run_pool(paths_input_files, data_target, caches, max_workers=MAX_WORKERS):
+	"""
+	Runs process_supplier for all supplier files in a process pool.
+	If a worker process dies, the pool is broken and all its pending supplier files fail, so these are run again
+	with run_isolated, and only the supplier file that crashes its worker fails.
+	INPUT:
+		- paths_input_files: list of paths to the supplier json files
+		- data_target: target dataset
+		- caches: dictionary with the caches that are shared between the workers
+		- max_workers: number of worker processes
+	OUTPUT:
+		- list with the result of process_supplier for each supplier file, in the order of paths_input_files
+	"""
+	results = [None] * len(paths_input_files)
+	idx_broken = []
+
+	with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(data_target, caches)) as executor:
+		futures = [executor.submit(process_supplier, p) for p in paths_input_files]
+		for ii, (path_input_file, future) in enumerate(zip(paths_input_files, futures)):
+			try:
+				results[ii] = future.result()
+			except BrokenProcessPool:
+				idx_broken.append(ii)
+			except Exception:
+				results[ii] = (path_input_file, None, None, traceback.format_exc())
+
+	if len(idx_broken) > 0:
+		results_broken = run_isolated([paths_input_files[ii] for ii in idx_broken], data_target, caches, max_workers=max_workers)
+		for ii, result in zip(idx_broken, results_broken):
+			results[ii] = result
+
+	return results
+
+
+def run_batch(paths_input_files, data_target, path_xlsx_output, max_workers=MAX_WORKERS, path_schema_mapping=None):
+	"""
+	Preprocesses and normalises all supplier files in parallel and integrates them into the target dataset in one pass.
+	The make cache is shared between the worker processes. The normalisation steps that call an external API
+	(color translation, geocoding) run once in this process on all supplier datasets together, so every distinct color
+	and city is resolved only once. If they fail, they are run again per supplier dataset to only skip the failing ones.
+	INPUT:
+		- paths_input_files: list of paths to the supplier json files
+		- data_target: target dataset
+		- path_xlsx_output: full path where to save the final xlsx file
+		- max_workers: number of worker processes
+		- path_schema_mapping: (optional) path to a json file with the mapping to the target schema
+	OUTPUT:
+		- tuple of the integrated pandas dataframe and a dictionary with the error message per failed supplier file
+	"""
+	errors = {}
+
+	with Manager() as manager:
+		results = run_pool(paths_input_files, data_target, {'make': manager.dict()}, max_workers=max_workers)
+
+	list_prepro, list_norm = [], []
+	for path_input_file, data_prepro, data_norm, error in results:
+		if error is not None:
+			print(f"Error in run_batch! Supplier file {path_input_file} failed and is skipped:\n{error}")
+			errors[path_input_file] = error
+			continue
+		data_prepro[COL_SUPPLIER] = path_input_file
+		data_norm[COL_SUPPLIER] = path_input_file
+		list_prepro.append(data_prepro)
+		list_norm.append(data_norm)
+
+	assert len(list_norm) > 0, "Error in run_batch! All supplier files failed."
+
+	data_prepro = pd.concat(list_prepro)
+	data_norm = pd.concat(list_norm)
+
+	# external API calls once for all suppliers, the caches keep the results if they have to be repeated per supplier
+	caches = {'color': {}, 'country': {}}
+	try:
+		data_norm, failed_remote = main_normaliser.normalise_remote(data_norm, data_target, caches=caches), False
+	except Exception:
+		print(f"Error in run_batch! Normalisation of all supplier files failed, it is run again per supplier file:\n{traceback.format_exc()}")
+		failed_remote = True
+
+	if failed_remote:
+		list_norm_remote = []
+		for path_input_file, data_supplier in data_norm.groupby(COL_SUPPLIER, sort=False):
+			try:
+				list_norm_remote.append(main_normaliser.normalise_remote(data_supplier.copy(), data_target, caches=caches))
+			except Exception:
+				error = traceback.format_exc()
+				print(f"Error in run_batch! Supplier file {path_input_file} failed and is skipped:\n{error}")
+				errors[path_input_file] = error
+		assert len(list_norm_remote) > 0, "Error in run_batch! All supplier files failed."
+		data_norm = pd.concat(list_norm_remote)
+		data_prepro = data_prepro[~data_prepro[COL_SUPPLIER].isin(errors.keys())]
+
+	# integrate all suppliers in one pass, columns not in the target (e.g. COL_SUPPLIER) are dropped
+	data_integr = main_integrator.integrate_datasets(
+														data_norm=data_norm,
+														data_target=data_target,
+														path_xlsx_output=path_xlsx_output,
+														integrator=None,
+														df_prepro=data_prepro,
+														df_norm=data_norm,
+														path_schema_mapping=path_schema_mapping
+													)
+
+	return data_integr, errors
+
+
+def main(path_manifest_file, path_target_file, path_xlsx_output, path_schema_mapping=None):
+	# read target dataframe
+	data_target = pd.read_excel(path_target_file)
+
+	paths_input_files = read_manifest(path_manifest_file)
+
+	data_integr, errors = run_batch(paths_input_files, data_target, path_xlsx_output, path_schema_mapping=path_schema_mapping)
+
+	print(f"Integrated {len(paths_input_files) - len(errors)} of {len(paths_input_files)} supplier files.")
+
+	return data_integr
+
+
+
+
+if __name__ == '__main__':
+	# Get the arguments from the command-line except the filename
+	argv = sys.argv[1:]
+
+	try:
+		if len(argv) == 4:
+			main(argv[0], argv[1], argv[2], argv[3])
+		elif len(argv) == 3:
+			main(argv[0], argv[1], argv[2])
+		elif len(argv) == 0:
+			main(path_manifest_file, path_target_file, path_xlsx_output)
+		else:
+			print('Error! usage: main_batch.py (optional: path_manifest_file path_target_file path_xlsx_output (optional: path_schema_mapping))')
+			sys.exit(2)
+
+	except getopt.GetoptError:
+		# Print something useful
+		print('Error! usage: main_batch.py (optional: path_manifest_file path_target_file path_xlsx_output (optional: path_schema_mapping))')
+
+		sys.exit(2)
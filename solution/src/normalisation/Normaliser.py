@@ -1,12 +1,45 @@
+import os
 import pandas as pd
 pd.set_option('display.max_columns', 500)
 import webcolors
 import numpy as np
 import re
+import unicodedata
 from googletrans import Translator
 import jellyfish
 import geopandas
 from geopy.geocoders import Nominatim
+from scipy.spatial import cKDTree
+
+# RGB values of colors that are not defined in the css3 specification (from colorcombos.com)
+DIC_RGB_EXTRA = {
+            'anthracite': (56, 62, 66),
+            'bordeaux': (95, 2, 31)
+            }
+
+# csv file with the cities and their districts that are removed as suffix (e.g. "Zürich-Oerlikon") before geocoding
+PATH_CITY_DISTRICTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'city_districts.csv')
+
+# css3 colors that are indexed as anchors for each target color, so that shades (e.g. navy) are matched to their target color (Blue).
+# Colors close to the anchors of "Other" are classified as "Other". Target colors that are not listed are indexed with their own css3 color.
+DIC_COLOR_ANCHORS = {
+            'Black': ['black'],
+            'White': ['white', 'snow', 'ivory', 'whitesmoke'],
+            'Silver': ['silver', 'lightgray', 'gainsboro'],
+            'Gray': ['gray', 'dimgray', 'darkgray', 'slategray', 'darkslategray', 'lightslategray'],
+            'Blue': ['blue', 'navy', 'darkblue', 'mediumblue', 'midnightblue', 'royalblue', 'steelblue', 'dodgerblue',
+                    'cornflowerblue', 'deepskyblue', 'skyblue', 'lightblue', 'lightsteelblue'],
+            'Red': ['red', 'darkred', 'maroon', 'firebrick', 'crimson', 'indianred'],
+            'Green': ['green', 'darkgreen', 'forestgreen', 'seagreen', 'mediumseagreen', 'olivedrab', 'darkolivegreen',
+                    'limegreen', 'lime', 'lightgreen', 'olive'],
+            'Yellow': ['yellow', 'lightyellow', 'lemonchiffon'],
+            'Orange': ['orange', 'darkorange', 'coral', 'tomato'],
+            'Beige': ['beige', 'wheat', 'tan', 'khaki', 'bisque', 'navajowhite', 'antiquewhite'],
+            'Brown': ['saddlebrown', 'sienna', 'chocolate', 'peru'],
+            'Gold': ['gold', 'goldenrod', 'darkgoldenrod'],
+            'Purple': ['purple', 'violet', 'magenta', 'darkviolet', 'darkmagenta', 'indigo', 'mediumpurple', 'blueviolet', 'plum', 'orchid'],
+            'Other': ['pink', 'lightpink', 'hotpink', 'deeppink', 'turquoise', 'cyan', 'aquamarine', 'teal']
+            }
 
 
 class Normaliser():
@@ -40,11 +73,106 @@ class Normaliser():
         return data
 
 
-    def normalise_color(self, dataframe, dataframe_target, dic_colors=None, verbose=False):
+    def color_to_rgb(self, color, dic_rgb_extra=DIC_RGB_EXTRA):
+        """
+        Resolves a color name into its RGB value using the css3 color names of webcolors.
+        INPUT:
+            - color: name of the color, e.g. "Red"
+            - dic_rgb_extra: dictionary with RGB values for lowercase color names that are not defined in css3
+        OUTPUT:
+            - tuple with the (red, green, blue) values or None if the color name could not be resolved
+        """
+        if type(color) != str:
+            return None
+
+        color = color.strip().lower()
+        if color in dic_rgb_extra:
+            return tuple(dic_rgb_extra[color])
+        try:
+            rgb = webcolors.name_to_rgb(color.replace(' ', ''), spec='css3')
+        except ValueError:
+            return None
+
+        return (rgb[0], rgb[1], rgb[2])
+
+
+    def rgb_to_lab(self, rgb):
+        """
+        Converts sRGB values into the CIELAB color space (D65 white point), in which the euclidean distance (Delta E)
+        follows the perceived difference between two colors.
+        INPUT:
+            - rgb: numpy array of shape (n, 3) with the (red, green, blue) values from 0 to 255
+        OUTPUT:
+            - numpy array of shape (n, 3) with the (L, a, b) values
+        """
+        c = np.asarray(rgb, dtype=float) / 255.0
+        c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92) # linear RGB
+        m = np.asarray([[0.4124, 0.3576, 0.1805],
+                        [0.2126, 0.7152, 0.0722],
+                        [0.0193, 0.1192, 0.9505]])
+        xyz = c.dot(m.T) / np.asarray([0.95047, 1.0, 1.08883])
+        f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+
+        return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+    def match_colors_nearest(self, colors, target_colors, max_distance=30.0, dic_color_anchors=DIC_COLOR_ANCHORS, verbose=False):
+        """
+        Matches each color to the target color of the closest anchor color, closeness is defined by the euclidean distance in the CIELAB space (Delta E).
+        A KD-tree is built once over the anchors of the target colors (see DIC_COLOR_ANCHORS) and all colors are assigned in a single batched query.
+        Colors that are exact matches are kept, colors that can not be resolved to RGB or whose closest anchor
+        is further away than max_distance are classified as "Other".
+        INPUT:
+            - colors: list of the distinct colors to be matched
+            - target_colors: list of the distinct colors in the target dataset
+            - max_distance: maximal Delta E to accept the closest anchor as a match
+            - dic_color_anchors: dictionary with the list of css3 anchor colors for each target color
+            - verbose: If true, will print information for which colors no match was found
+        OUTPUT:
+            - dictionary with the mapping from each color to the matched target color
+        """
+        dic_match = {c: c for c in colors if c in target_colors} # exact matches
+
+        # palette index over the anchors of the target colors that can be resolved to RGB
+        palette = []
+        for c in list(dict.fromkeys(target_colors + ['Other'])):
+            for anchor in dic_color_anchors.get(c, [c] if c != 'Other' else []):
+                palette.append((c, self.color_to_rgb(anchor)))
+        palette = [(c, rgb) for c, rgb in palette if rgb is not None]
+
+        # colors to be matched in the CIELAB space
+        to_match = [(c, self.color_to_rgb(c)) for c in colors if c not in dic_match]
+        for c, rgb in to_match:
+            if rgb is None:
+                if verbose: print(f"Color {c} could not be resolved to RGB.")
+                dic_match[c] = 'Other'
+        to_match = [(c, rgb) for c, rgb in to_match if rgb is not None]
+
+        if len(palette) == 0 or len(to_match) == 0:
+            for c, _ in to_match:
+                dic_match[c] = 'Other'
+            return dic_match
+
+        tree = cKDTree(self.rgb_to_lab([rgb for _, rgb in palette]))
+        _, idx = tree.query(self.rgb_to_lab([rgb for _, rgb in to_match]), k=1, distance_upper_bound=max_distance)
+
+        # the query returns idx == len(palette) if there is no target color within max_distance
+        for (c, _), i in zip(to_match, idx):
+            if i < len(palette):
+                dic_match[c] = palette[i][0]
+            else:
+                if verbose: print(f"For color {c}, no anchor color was found within a distance of {max_distance}.")
+                dic_match[c] = 'Other'
+
+        return dic_match
+
+
+    def normalise_color(self, dataframe, dataframe_target, dic_colors=None, method='exact', max_distance=30.0, cache=None, verbose=False):
         """
         Normalisation of the BodyColorText column of the dataframe.
-        Uses exact color matching, so the color has to be present in the target dataframe, otherwise it will be an "Other" color.
-        For a probabilistic approach using the RGB space, see the ipynb file.
+        With method "exact", uses exact color matching, so the color has to be present in the target dataframe, otherwise it will be an "Other" color.
+        With method "nearest", colors that are not present in the target dataframe are matched to the closest target color in the CIELAB space
+        (see match_colors_nearest), only colors that can not be resolved or are too far away will be an "Other" color.
 
         The idea is to first see what colors we have in the target set and then define a mapping function to assign the respective
         colors to the colors in the input dataset.
@@ -55,6 +183,10 @@ class Normaliser():
             - dataframe_target: target dataframe from the xls file
             - dic_colors: (optional) Is a dictionary that is the translation of the colors from German to English.
                             If not provided, a translator will be used.
+            - method: "exact" or "nearest", the method used to match the colors to the target colors
+            - max_distance: maximal Delta E in the CIELAB space for a match, only used with method "nearest"
+            - cache: (optional) dictionary-like object with the already translated colors, only used if dic_colors is None.
+                            New translations are added to it, so it can be shared between calls (e.g. a multiprocessing Manager dict).
             - verbose: If true, will print information if dic_colors was None or not
         OUTPUT:
             - dataframe: The input dataframe with the color column normalised.
@@ -64,6 +196,7 @@ class Normaliser():
         assert type(dataframe) == type(pd.DataFrame()), "Error in normalise_color! dataframe is not of type pd.DataFrame()"
         assert type(dataframe_target) == type(pd.DataFrame()), "Error in normalise_color! dataframe_target is not of type pd.DataFrame()"
         if dic_colors: assert type(dic_colors) == type({}), "Error in normalise_color! dic_color is not of type dictionary"
+        assert method in ['exact', 'nearest'], f"Error in normalise_color! method is {method}, must be 'exact' or 'nearest'"
         assert 'BodyColorText' in dataframe.columns.tolist(), "Error in normalise_color! BodyColorText is not in the columns of the dataframe"
         assert 'color' in dataframe_target.columns.tolist(), "Error in normalise_color! color is not in the columns of the dataframe_target"
 
@@ -91,12 +224,24 @@ class Normaliser():
             dic_colors = {} # translated colors
 
             for c in colors:
-                dic_colors[c] = translate_color(c)
+                if cache is not None and c in cache:
+                    dic_colors[c] = cache[c]
+                else:
+                    dic_colors[c] = translate_color(c)
+                    if cache is not None: cache[c] = dic_colors[c]
 
 
         # also make it all first letter uppercase
         dataframe['BodyColorText_trans'] = dataframe['BodyColorText_new'].apply(lambda x: dic_colors[x].capitalize() )
 
+        if method == 'nearest':
+            # match all distinct colors at once to the closest color of the target dataframe
+            target_colors = dataframe_target['color'].dropna().unique().tolist()
+            dic_match = self.match_colors_nearest(dataframe['BodyColorText_trans'].unique().tolist(), target_colors, max_distance=max_distance, verbose=verbose)
+            dataframe['color'] = dataframe['BodyColorText_trans'].map(dic_match)
+
+            return dataframe
+
         # find exact matches of colors from the target dataframe
         def match_color(color, target_colors=[]):
             if color in target_colors:
@@ -111,7 +256,7 @@ class Normaliser():
 
 
 
-    def normalise_make(self, dataframe, dataframe_target, threshold=0.879, verbose=False):
+    def normalise_make(self, dataframe, dataframe_target, threshold=0.879, cache=None, verbose=False):
         """
         The idea is to compare the similarity between the words in the target dataset and the input dataset to match the car makers.
         For that I will use the Jaro-Winkler distance (JW score). It is best suited for short strings such as names with the goal of comparing these two names.
@@ -121,6 +266,8 @@ class Normaliser():
             - dataframe: preprocessed dataset that is a pandas dataframe.
             - dataframe_target: target dataframe from the xls file
             - threshold: Threshold below which the JW score will result in the make attribute being classified as "Other"
+            - cache: (optional) dictionary-like object with the best match and JW score of already compared makers.
+                            New comparisons are added to it, so it can be shared between calls (e.g. a multiprocessing Manager dict).
             - verbose: If true, will print information for which make attributes the JW score was below threshold
         OUTPUT:
             - dataframe: The input dataframe with the make column normalised.
@@ -144,13 +291,17 @@ class Normaliser():
 
 
         def compare_makers(row, makers_target, makers_target_lowercase, threshold, verbose=False):
-            # make input lowercase
-            s = row.lower()
-            # calculate jaro-winkler score between the lowercase strings
-            jw_scores = makers_target_lowercase.apply(lambda x: jellyfish.jaro_winkler(s, x))
-            idx_max = np.argmax(jw_scores) # maximal score index
-            score_max = jw_scores.iloc[idx_max]
-            best_match = makers_target.iloc[idx_max]
+            if cache is not None and row in cache:
+                best_match, score_max = cache[row]
+            else:
+                # make input lowercase
+                s = row.lower()
+                # calculate jaro-winkler score between the lowercase strings
+                jw_scores = makers_target_lowercase.apply(lambda x: jellyfish.jaro_winkler(s, x))
+                idx_max = np.argmax(jw_scores) # maximal score index
+                score_max = jw_scores.iloc[idx_max]
+                best_match = makers_target.iloc[idx_max]
+                if cache is not None: cache[row] = (best_match, score_max)
             if score_max < threshold:
                 if verbose: print(f"For input {row}, the best match was {best_match} with a JW score of {score_max}.")
 
@@ -167,31 +318,141 @@ class Normaliser():
         return dataframe
 
 
-    def get_country_from_city(self, dataframe):
+    def load_city_districts(self, path_city_districts=PATH_CITY_DISTRICTS):
+        """
+        Loads the districts of the cities that are removed as suffix from the city names (e.g. "Zürich-Oerlikon").
+        INPUT:
+            - path_city_districts: path to the csv file with the columns city and district
+        OUTPUT:
+            - list of tuples (city, district)
+        """
+        df_districts = pd.read_csv(path_city_districts, dtype=str).dropna()
+        assert 'city' in df_districts.columns and 'district' in df_districts.columns, f"Error in load_city_districts! {path_city_districts} must have the columns city and district."
+
+        return list(zip(df_districts['city'].str.strip(), df_districts['district'].str.strip()))
+
+
+    def canonicalise_cities(self, cities, threshold=0.95, path_city_districts=PATH_CITY_DISTRICTS):
+        """
+        Groups the spelling variants of the same city into clusters, so that every cluster has to be geocoded only once.
+        A normalised key is built for every city: case folding, transliteration of ae/oe/ue, removal of diacritics, postal codes
+        and dots, collapsed whitespace, and removal of a district suffix listed in the city districts file (e.g. "Zürich-Oerlikon",
+        "Zürich Oerlikon" or "Zürich (Oerlikon)"). Any other hyphen or bracket is kept, as they are part of city names
+        (e.g. "Baden-Baden" or "Rheinfelden (Baden)").
+        Cities with the same key are clustered. Keys that start with the same letter are compared with the Jaro-Winkler score:
+        a key is merged into a more frequent one only if the score is at least threshold and both have the same number of letters
+        (e.g. "zurihc" and "zurich"), otherwise the similar key is only reported as suggestion (e.g. "feldkirchen" and "feldkirch").
+        INPUT:
+            - cities: pandas series with the (raw) city names, the most frequent spelling of a cluster is used to geocode it
+            - threshold: JW score above which similar keys are merged or reported as suggestion
+            - path_city_districts: path to the csv file with the city districts, see load_city_districts
+        OUTPUT:
+            - pandas dataframe with the columns City (distinct raw city names), city_key (normalised key),
+                cluster (raw city name that represents the cluster) and suggestion (cluster of a similar key, not merged)
+        """
+        assert type(threshold) == type(0.95), f"Error in canonicalise_cities! threshold is not of type {type(0.95)}"
+
+        def normalise_city(city):
+            key = re.sub(r'([aou])e', r'\1', str(city).casefold()) # transliteration, e.g. zuerich -> zurich
+            key = unicodedata.normalize('NFKD', key)
+            key = ''.join(ch for ch in key if not unicodedata.combining(ch)) # remove diacritics
+            key = re.sub(r'\d+', ' ', key) # remove postal codes
+            key = key.replace('.', ' ') # e.g. st.gallen -> st gallen
+            key = re.sub(r'\s*([-/])\s*', r'\1', key) # remove whitespace around hyphens and slashes
+            key = re.sub(r'\s*\(\s*', ' (', key).replace(' )', ')')
+            return re.sub(r'\s+', ' ', key).strip(' ,-/')
+
+        # key of the city with district suffix -> key of the city
+        dic_districts = {}
+        for city, district in self.load_city_districts(path_city_districts):
+            for city_district in [f"{city}-{district}", f"{city} {district}", f"{city} ({district})"]:
+                dic_districts[normalise_city(city_district)] = normalise_city(city)
+
+        def city_key(city):
+            key = normalise_city(city)
+            return dic_districts.get(key, key) # remove district suffix
+
+        counts = cities.dropna().value_counts() # sorted by frequency
+        df_city = pd.DataFrame({'City': counts.index, 'city_key': [city_key(c) for c in counts.index]})
+
+        def n_letters(key):
+            return len(re.sub(r'[^0-9a-z]', '', key))
+
+        # merge the similar keys of the same length into the more frequent key, suggest the other similar keys
+        dic_clusters = {} # key -> key that represents the cluster
+        dic_suggestion = {} # key -> key that represents the cluster of the similar key
+        dic_blocks = {} # first letter -> list of keys
+        for key in df_city['city_key'].unique():
+            block = dic_blocks.setdefault(key[:1], [])
+            scores = [jellyfish.jaro_winkler(key, other) for other in block]
+            dic_clusters[key] = key
+            if len(scores) > 0 and max(scores) >= threshold:
+                other = block[int(np.argmax(scores))]
+                if n_letters(key) == n_letters(other):
+                    dic_clusters[key] = dic_clusters[other]
+                else:
+                    dic_suggestion[key] = dic_clusters[other]
+            block.append(key)
+
+        # the most frequent raw city name of a key represents the cluster
+        dic_representative = df_city.drop_duplicates('city_key').set_index('city_key')['City'].to_dict()
+        df_city['cluster'] = df_city['city_key'].map(dic_clusters).map(dic_representative)
+        df_city['suggestion'] = df_city['city_key'].map(dic_suggestion).map(dic_representative)
+
+        return df_city
+
+
+    def get_country_from_city(self, dataframe, cache=None, canonicalise=True, threshold_city=0.95, verbose=False):
         """
         Uses geopandas to get the country for the city. If one than more address for a city is found there will be an error.
+        If canonicalise is True, the spelling variants of a city are clustered (see canonicalise_cities) and only one city per cluster is geocoded.
+        For audit, the columns CityCluster (city that was geocoded) and CitySuggestion (similar cluster that was not merged) are added
+        to the dataframe, and the mapping of the cities to the clusters and countries is stored in the attribute df_city_country.
         INPUT:
             - dataframe: pandas dataframe that must contain a city column
+            - cache: (optional) dictionary-like object with the country of already geocoded cities.
+                            New results are added to it, so it can be shared between calls (e.g. a multiprocessing Manager dict).
+            - canonicalise: If true, geocodes one city per cluster of spelling variants instead of every distinct city
+            - threshold_city: JW score above which a similar cluster of the same length is merged, otherwise reported as suggestion, only used if canonicalise is True
+            - verbose: If true, will print the mapping of the cities to the clusters and countries
         OUTPUT:
-            - pandas dataframe with the country that the city is in
+            - pandas dataframe with the country that the city is in and the city clusters
         """
         assert type(dataframe) == type(pd.DataFrame()), "Dataframe is not a pd.DataFrame()!"
         assert 'City' in dataframe.columns, "City is not a columns in the dataframe!"
 
-        df_city = pd.DataFrame(dataframe['City'].unique(), columns=['City'])
+        if canonicalise:
+            df_city = self.canonicalise_cities(dataframe['City'], threshold=threshold_city)
+        else:
+            df_city = pd.DataFrame(dataframe['City'].dropna().unique(), columns=['City'])
+            df_city['cluster'] = df_city['City']
+            df_city['suggestion'] = np.nan
 
         def get_country(city):
+            if cache is not None and city in cache:
+                return cache[city]
             r = geopandas.tools.geocode(city, provider='nominatim', user_agent='autogis_xx', timeout=4) # get address
             assert r.shape[0] == 1, "More than one address for that city!" # make sure only one city
             long, lat = r['geometry'].x.values[0], r['geometry'].y.values[0] # get long and lat
             locator = Nominatim(user_agent="myGeocoder")
             coordinates = f"{lat}, {long}"
             location = locator.reverse(coordinates) # get location information
-            country = location.raw['address']['country_code'] # return country code
-            return country.upper()
-
-        df_city['Country'] = df_city['City'].apply(lambda x: get_country(x))
-
-        dataframe['Country'] = dataframe['City'].apply(lambda x: df_city[ df_city['City'] == x ].loc[:, 'Country'].values[0])
+            country = location.raw['address']['country_code'].upper() # return country code
+            if cache is not None: cache[city] = country
+            return country
+
+        # geocode every cluster once
+        dic_country = {c: get_country(c) for c in df_city['cluster'].unique()}
+        df_city['Country'] = df_city['cluster'].map(dic_country)
+        self.df_city_country = df_city
+
+        if verbose:
+            print(f"Geocoded {len(dic_country)} clusters for {len(df_city)} distinct cities:")
+            print(df_city)
+
+        df_city = df_city.set_index('City')
+        dataframe['CityCluster'] = dataframe['City'].map(df_city['cluster'])
+        dataframe['CitySuggestion'] = dataframe['City'].map(df_city['suggestion'])
+        dataframe['Country'] = dataframe['City'].map(df_city['Country'])
 
         return dataframe
\ No newline at end of file
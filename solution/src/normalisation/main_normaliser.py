@@ -25,33 +25,83 @@ dic_colors = {'anthrazit': 'anthracite',
 # threshold to classify make as "Other" based on JW distance
 THRESHOLD_NORMALISE_MAKE = 0.879
 
+# method to match the colors to the target colors: 'exact' or 'nearest' (closest color in the CIELAB space)
+METHOD_NORMALISE_COLOR = 'exact'
+# maximal Delta E in the CIELAB space to match a color, otherwise it is classified as "Other"
+MAX_DISTANCE_NORMALISE_COLOR = 30.0
+
+# cluster the spelling variants of a city before geocoding and the JW score above which a similar city of the same length is merged,
+# otherwise it is reported as suggestion
+CANONICALISE_CITY = True
+THRESHOLD_CITY = 0.95
+
 # verboses for testing
 VERBOSE_NORMALISE_MAKE = False
 VERBOSE_NORMALISE_COLOR = False
+VERBOSE_COUNTRY = False
 
-def normalise_dataframe(data_supplier, data_target):
+def normalise_local(data_supplier, data_target, caches=None):
 	"""
-	Normalises the supplier dataset.
+	Runs the normalisation steps of the supplier dataset that do not call an external API (make).
 	INPUT:
 		- data_supplier: preprocessed supplier dataset, must be in wide format
 		- data_target: target dataset
+		- caches: (optional) dictionary with the key 'make' holding a dictionary-like cache that is shared between calls,
+					e.g. between the workers of the batch mode
 	OUTPUT:
 		- pandas dataframe
 	"""
+	if caches is None: caches = {}
+
+	norm = Normaliser(path_preprocessed_file=None, path_target_file=None)
+
+	# normalise make
+	data_supplier = norm.normalise_make(data_supplier, data_target, threshold=THRESHOLD_NORMALISE_MAKE, cache=caches.get('make'), verbose=VERBOSE_NORMALISE_MAKE)
+
+	return data_supplier
+
+
+def normalise_remote(data_supplier, data_target, caches=None):
+	"""
+	Runs the normalisation steps of the supplier dataset that call an external API (color translation, geocoding).
+	The APIs are called once per distinct color and city, so in the batch mode this runs once on all supplier datasets together.
+	INPUT:
+		- data_supplier: preprocessed supplier dataset, must be in wide format
+		- data_target: target dataset
+		- caches: (optional) dictionary with the keys 'color' and 'country' holding dictionary-like caches that are reused between calls
+	OUTPUT:
+		- pandas dataframe
+	"""
+	if caches is None: caches = {}
 
 	norm = Normaliser(path_preprocessed_file=None, path_target_file=None)
 
 	# normalise color: if google API does not work
-	# data_supplier = norm.normalise_color(data_supplier, data_target, dic_colors=dic_colors, verbose=VERBOSE_NORMALISE_COLOR)
+	# data_supplier = norm.normalise_color(data_supplier, data_target, dic_colors=dic_colors, method=METHOD_NORMALISE_COLOR, max_distance=MAX_DISTANCE_NORMALISE_COLOR, verbose=VERBOSE_NORMALISE_COLOR)
 
 	# normalise color: if google API does work
-	data_supplier = norm.normalise_color(data_supplier, data_target, dic_colors=None, verbose=VERBOSE_NORMALISE_COLOR)
-
-	# normalise make
-	data_supplier = norm.normalise_make(data_supplier, data_target, threshold=THRESHOLD_NORMALISE_MAKE, verbose=VERBOSE_NORMALISE_MAKE)
+	data_supplier = norm.normalise_color(data_supplier, data_target, dic_colors=None, method=METHOD_NORMALISE_COLOR, max_distance=MAX_DISTANCE_NORMALISE_COLOR, cache=caches.get('color'), verbose=VERBOSE_NORMALISE_COLOR)
 
 	# get country from city
-	data_supplier = norm.get_country_from_city(data_supplier)
+	data_supplier = norm.get_country_from_city(data_supplier, cache=caches.get('country'), canonicalise=CANONICALISE_CITY, threshold_city=THRESHOLD_CITY, verbose=VERBOSE_COUNTRY)
+
+	return data_supplier
+
+
+def normalise_dataframe(data_supplier, data_target, caches=None):
+	"""
+	Normalises the supplier dataset.
+	INPUT:
+		- data_supplier: preprocessed supplier dataset, must be in wide format
+		- data_target: target dataset
+		- caches: (optional) dictionary with the keys 'color', 'make' and 'country' holding dictionary-like caches
+					that are reused between calls
+	OUTPUT:
+		- pandas dataframe
+	"""
+	data_supplier = normalise_local(data_supplier, data_target, caches=caches)
+
+	data_supplier = normalise_remote(data_supplier, data_target, caches=caches)
 
 	return data_supplier
 
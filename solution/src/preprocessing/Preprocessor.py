@@ -92,12 +92,9 @@ class Preprocessor():
         OUTPUT:
             - pandas dataframe with new order
         """
-        data_out = pd.DataFrame()
-        for new_col in col_order:
-            if new_col in dataframe.columns: data_out[new_col] = dataframe[new_col]
-        for c in dataframe.columns:
-            if c not in data_out.columns:
-                data_out.loc[:, c] = dataframe.loc[:, c]
+        cols_ordered = [c for c in col_order if c in dataframe.columns]
+        cols = cols_ordered + [c for c in dataframe.columns if c not in cols_ordered]
+        data_out = dataframe[cols] # select all columns in one operation
         assert len(data_out.columns) == len(dataframe.columns), 'Length of resorted columns is not the same!'
 
         return data_out